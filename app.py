@@ -1,120 +1,369 @@
 # app.py
+import numpy as np
 import pandas as pd
-import yfinance as yf
-from flask import Flask, render_template, request
+from flask import Flask, g, render_template, request
+from flask.json.provider import DefaultJSONProvider
 import os
+import functools
 import logging
 import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import json
 
 # --- Configuration ---
 PORTFOLIO_CSV = 'portfolio.csv'
-RSU_TICKERS = ['META']
+PORTFOLIO_COLUMNS = ['Ticker', 'Quantity', 'CostBasis']  # Other CSV columns are ignored
+RSU_TICKERS = frozenset({'META'})
+CACHE_TTL = 60  # Seconds a fetched price is served from memory before hitting yfinance again
+META_CACHE_TTL = 24 * 60 * 60  # Seconds currency/short name are reused; they don't change intraday
+QUOTE_URL = 'https://query1.finance.yahoo.com/v7/finance/quote'
+QUOTE_BATCH_SIZE = 20  # Symbols per quote request; Yahoo serves roughly this many per call
+FETCH_MAX_WORKERS = 8  # Max threads for concurrent quote batches / per-ticker fallback lookups (I/O bound)
+REFRESH_SEC = 60  # How often the background thread re-fetches quotes for the page snapshot (history: HIST_RECHECK_SEC)
+HIST_CACHE_DIR = 'hist_cache'  # Per-ticker daily closes ({ticker}.parquet); only days from the last cached one on are downloaded
+HIST_ADJUST_RTOL = 1e-3  # Relative change in an already-cached close that means Yahoo re-adjusted the history (split/dividend)
+HIST_RECHECK_SEC = 60 * 60  # A cached ticker's history is re-checked with Yahoo at most this often (file mtime = last check)
+QUOTE_CACHE_FILE = os.path.join(HIST_CACHE_DIR, 'quotes.json')  # Quote caches persisted so a restarted worker starts warm
+QUOTE_DISK_TTL = 60 * 60  # Max age of persisted prices served on the first page load after a restart
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s')
 
 # --- Flask App Initialization ---
+class NumpyJSONProvider(DefaultJSONProvider):
+    # app.json for jsonify and the chart payloads: numpy arrays/scalars serialize as lists/numbers. With orjson installed,
+    # compact output is written by orjson straight from the array buffers; options it lacks (indent in debug) use stdlib json.
+    sort_keys = False
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, (np.ndarray, np.generic)): return o.tolist()
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        try: import orjson
+        except ImportError: return super().dumps(obj, **kwargs)
+        if set(kwargs) - {'separators'}: return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME).decode()
+
 app = Flask(__name__)
+app.json = NumpyJSONProvider(app)
+
+def _profiled(wsgi_app):
+    # Opt-in cProfile for single requests: with PROFILE_REQUESTS=1, '/?profile=1' prints the top cumulative entries to stdout.
+    from werkzeug.middleware.profiler import ProfilerMiddleware
+    profiler = ProfilerMiddleware(wsgi_app, sort_by=('cumulative',), restrictions=(30,))
+    def dispatch(environ, start_response):
+        if 'profile=1' in environ.get('QUERY_STRING', '').split('&'): return profiler(environ, start_response)
+        return wsgi_app(environ, start_response)
+    return dispatch
+
+if os.environ.get('PROFILE_REQUESTS') == '1': app.wsgi_app = _profiled(app.wsgi_app)
+
+# --- In-Process Caches ---
+_price_cache = {}  # {ticker: (fetched_at, current_price)}
+_meta_cache = {}  # {ticker: (fetched_at, (currency, short_name))}
+_cache_lock = threading.Lock()  # Guards both quote caches; the refresher thread and request threads share them
+_quote_cache_loaded = False
+_SNAPSHOT = {}  # {'portfolio_key': (mtime_ns, size), 'stock_data': {...}, 'historical_data': {...}, 'historical_at': ts}; read by index()
+_snapshot_lock = threading.Lock()
+_refresh_lock = threading.Lock()  # Serializes refreshes so concurrent cold requests don't all hit Yahoo
+_refresher_thread = None
 
 # --- Helper Functions ---
+def _read_portfolio_csv(csv_path):
+    # Only the required columns are parsed. pyarrow parses straight into the target dtypes; it raises on non-numeric
+    # cells or a missing column instead of coercing, so those files (and installs without pyarrow) go through the
+    # default parser + to_numeric(errors='coerce'), which leaves missing columns for the caller to report.
+    try: return pd.read_csv(csv_path, engine='pyarrow', usecols=PORTFOLIO_COLUMNS, dtype={'Ticker': 'string', 'Quantity': 'float64', 'CostBasis': 'float64'})
+    except (ImportError, ValueError, KeyError) as e: logging.info(f"pyarrow CSV read not used for '{csv_path}' ({e}), falling back to default parser.")
+    portfolio_df = pd.read_csv(csv_path, usecols=lambda col: col in PORTFOLIO_COLUMNS)
+    for col in ['Quantity', 'CostBasis']:
+        if col in portfolio_df.columns: portfolio_df[col] = pd.to_numeric(portfolio_df[col], errors='coerce')
+    return portfolio_df
+
 def load_portfolio_from_csv(csv_path):
-    # (Function remains the same)
-    required_columns = ['Ticker', 'Quantity', 'CostBasis']
+    # Parsed frames are memoized on (path, mtime, size), so an unchanged file is served from memory; callers get a copy.
+    required_columns = PORTFOLIO_COLUMNS
     try:
         if not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0: logging.warning(f"'{csv_path}' not found or empty."); return pd.DataFrame(columns=required_columns)
-        portfolio_df = pd.read_csv(csv_path)
-        if not all(col in portfolio_df.columns for col in required_columns): missing = [col for col in required_columns if col not in portfolio_df.columns]; raise ValueError(f"CSV missing columns: {missing}")
-        portfolio_df['Ticker'] = portfolio_df['Ticker'].astype(str).str.strip()
-        portfolio_df['Quantity'] = pd.to_numeric(portfolio_df['Quantity'], errors='coerce')
-        portfolio_df['CostBasis'] = pd.to_numeric(portfolio_df['CostBasis'], errors='coerce')
-        original_rows = len(portfolio_df)
-        portfolio_df.dropna(subset=['Quantity', 'CostBasis'], inplace=True)
-        portfolio_df = portfolio_df[portfolio_df['Quantity'] > 0]
-        if len(portfolio_df) < original_rows: logging.warning(f"Dropped {original_rows - len(portfolio_df)} rows due to invalid/zero data.")
-        logging.info(f"Loaded portfolio from '{csv_path}'.")
-        return portfolio_df
+        stat = os.stat(csv_path)
+        return _load_portfolio_cached(csv_path, stat.st_mtime_ns, stat.st_size).copy()
     except Exception as e: logging.error(f"Error loading portfolio CSV '{csv_path}': {e}", exc_info=True); return pd.DataFrame(columns=required_columns)
 
-def get_stock_data(tickers):
-    # (Function remains the same)
-     if not tickers: return {}
-     stock_data = {}; valid_tickers = [t for t in tickers if t];
-     if not valid_tickers: return {}
-     try:
+@functools.lru_cache(maxsize=4)
+def _load_portfolio_cached(csv_path, mtime_ns, size):
+    # mtime_ns/size are only part of the cache key; an edited file gets a new key and is re-read.
+    required_columns = PORTFOLIO_COLUMNS
+    portfolio_df = _read_portfolio_csv(csv_path)
+    if not all(col in portfolio_df.columns for col in required_columns): missing = [col for col in required_columns if col not in portfolio_df.columns]; raise ValueError(f"CSV missing columns: {missing}")
+    portfolio_df['Ticker'] = portfolio_df['Ticker'].astype(str).str.strip().str.upper()  # Yahoo's symbol case, so no lookups need to re-normalize
+    original_rows = len(portfolio_df)
+    mask = portfolio_df['Quantity'].notna() & portfolio_df['CostBasis'].notna() & (portfolio_df['Quantity'] > 0)
+    portfolio_df = portfolio_df.loc[mask]
+    if len(portfolio_df) < original_rows: logging.warning(f"Dropped {original_rows - len(portfolio_df)} rows due to invalid/zero data.")
+    logging.info(f"Loaded portfolio from '{csv_path}'.")
+    return portfolio_df
+
+def get_stock_data(tickers, max_age=CACHE_TTL):
+    # Prices younger than max_age and currency/names younger than META_CACHE_TTL are served from memory (seeded from
+    # QUOTE_CACHE_FILE on first use); only tickers with a stale price hit yfinance.
+    if not tickers: return {}
+    valid_tickers = [t for t in tickers if t]
+    if not valid_tickers: return {}
+    _load_quote_cache()
+    now = time.time()
+    with _cache_lock:
+        prices = {t: _price_cache[t][1] for t in valid_tickers if t in _price_cache and now - _price_cache[t][0] <= max_age}
+        meta = {t: _meta_cache[t][1] for t in prices if t in _meta_cache and now - _meta_cache[t][0] <= META_CACHE_TTL}
+    stock_data = {t: {'current_price': prices[t], 'currency': meta[t][0], 'short_name': meta[t][1]} for t in meta}
+    stale_tickers = [t for t in valid_tickers if t not in stock_data]
+    if not stale_tickers: logging.info(f"[Current Data] Served all {len(stock_data)} tickers from cache."); return stock_data
+    fetched = _fetch_stock_data(stale_tickers)
+    with _cache_lock:
+        for ticker, payload in fetched.items():
+            if not payload.get('current_price'): continue  # Don't pin fetch errors for a full TTL
+            _price_cache[ticker] = (now, payload['current_price'])
+            if payload['currency'] != 'N/A': _meta_cache[ticker] = (now, (payload['currency'], payload['short_name']))
+    _save_quote_cache()
+    stock_data.update(fetched)
+    return stock_data
+
+def _load_quote_cache():
+    global _quote_cache_loaded
+    import json
+    with _cache_lock:
+        if _quote_cache_loaded: return
+        _quote_cache_loaded = True
+        if not os.path.exists(QUOTE_CACHE_FILE): return
+        try:
+            with open(QUOTE_CACHE_FILE) as f: saved = json.load(f)
+            _price_cache.update({t: (fetched_at, price) for t, (fetched_at, price) in saved.get('prices', {}).items()})
+            _meta_cache.update({t: (fetched_at, tuple(meta)) for t, (fetched_at, meta) in saved.get('meta', {}).items()})
+            logging.info(f"[Current Data] Loaded {len(_price_cache)} cached quotes from '{QUOTE_CACHE_FILE}'.")
+        except Exception as e: logging.warning(f"[Current Data] Ignoring unreadable quote cache '{QUOTE_CACHE_FILE}': {e}")
+
+def _save_quote_cache():
+    import json
+    with _cache_lock: saved = {'prices': dict(_price_cache), 'meta': dict(_meta_cache)}
+    tmp_path = f"{QUOTE_CACHE_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"  # Thread ids repeat across forked workers
+    try:
+        os.makedirs(os.path.dirname(QUOTE_CACHE_FILE), exist_ok=True)
+        with open(tmp_path, 'w') as f: json.dump(saved, f)
+        os.replace(tmp_path, QUOTE_CACHE_FILE)
+    except Exception as e: logging.warning(f"[Current Data] Could not write quote cache '{QUOTE_CACHE_FILE}': {e}")
+
+def _clear_stock_cache():
+    # Memory only; a cleared process doesn't re-read QUOTE_CACHE_FILE.
+    global _quote_cache_loaded
+    with _cache_lock: _price_cache.clear(); _meta_cache.clear(); _quote_cache_loaded = True
+
+get_stock_data.cache_clear = _clear_stock_cache  # Same hook name as functools caches, for tests/manual resets
+
+def _batch_quote(tickers):
+    # v7 quote requests of QUOTE_BATCH_SIZE symbols each, issued concurrently -> {ticker: payload} for every ticker
+    # Yahoo priced. Goes through yfinance's shared session, which attaches the cookie/crumb Yahoo requires here.
+    batches = [tickers[i:i + QUOTE_BATCH_SIZE] for i in range(0, len(tickers), QUOTE_BATCH_SIZE)]
+    if len(batches) == 1: return _quote_one_batch(batches[0])
+    quotes = {}
+    with ThreadPoolExecutor(max_workers=min(FETCH_MAX_WORKERS, len(batches))) as ex:
+        for batch_quotes in ex.map(_quote_one_batch, batches): quotes.update(batch_quotes)
+    return quotes
+
+def _quote_one_batch(tickers):
+    # Never raises: a failed request yields {} so its tickers take the per-ticker fallback instead.
+    from yfinance.data import YfData
+    batch = set(tickers); quotes = {}
+    try: result = YfData().get_raw_json(QUOTE_URL, params={'symbols': ','.join(tickers), 'formatted': 'false'})
+    except Exception as e: logging.warning(f"[Current Data] Quote request failed for {tickers}: {e}"); return quotes
+    for quote in (result.get('quoteResponse') or {}).get('result') or []:
+        ticker = quote.get('symbol'); price = quote.get('regularMarketPrice')
+        if ticker in batch and price: quotes[ticker] = {'current_price': float(price), 'currency': quote.get('currency') or 'N/A', 'short_name': quote.get('shortName') or quote.get('longName') or ticker}
+    return quotes
+
+def _fetch_one(ticker):
+    # Per-ticker fallback for symbols the batch quote missed; returns (price, currency, short_name).
+    # A single chart-metadata request carries regularMarketPrice, currency and name. fast_info.last_price would
+    # download a year of daily bars, and .info scrapes quoteSummary.
+    import yfinance as yf
+    try:
+        md = yf.Ticker(ticker).get_history_metadata() or {}
+        currency = md.get('currency') or 'N/A'; price = md.get('regularMarketPrice')
+        if not price: return 0, currency, f"{ticker} (Price N/A)"
+        return float(price), currency, md.get('shortName') or md.get('longName') or ticker
+    except Exception as e_ticker: logging.error(f"Error getting current data for {ticker}: {e_ticker}", exc_info=True); return 0, 'N/A', f"{ticker} (Fetch Error)"
+
+def _fetch_stock_data(valid_tickers):
+    stock_data = {}
+    try:
         logging.info(f"[Current Data] Fetching for tickers: {valid_tickers}")
-        info_objects = yf.Tickers(valid_tickers)
-        for ticker in valid_tickers:
-            try:
-                info = info_objects.tickers[ticker.upper()].fast_info
-                current_price = info.get('last_price', info.get('previous_close'))
-                currency = info.get('currency', 'N/A'); short_name = info.get('shortName', ticker)
-                if current_price is not None: stock_data[ticker] = {'current_price': current_price, 'currency': currency, 'short_name': short_name}
-                else:
-                     logging.warning(f"fast_info failed for {ticker}, trying history(1d).")
-                     hist = yf.Ticker(ticker).history(period="1d")
-                     if not hist.empty:
-                         current_price = hist['Close'].iloc[-1]
-                         if 'currency' not in info or info['currency'] == 'N/A':
-                            try: full_info = yf.Ticker(ticker).info; currency = full_info.get('currency', 'N/A'); short_name = full_info.get('shortName', ticker)
-                            except Exception: logging.warning(f"Could not get full info for {ticker}")
-                         stock_data[ticker] = {'current_price': current_price, 'currency': currency, 'short_name': short_name}
-                     else: stock_data[ticker] = {'current_price': 0, 'currency': currency, 'short_name': f"{short_name} (Price N/A)"}
-            except Exception as e_ticker: logging.error(f"Error getting current data for {ticker}: {e_ticker}", exc_info=True); stock_data[ticker] = {'current_price': 0, 'currency': 'N/A', 'short_name': f"{ticker} (Fetch Error)"}
+        stock_data = _batch_quote(valid_tickers)
+        needs_fallback = [t for t in valid_tickers if t not in stock_data]
+        if needs_fallback:
+            logging.warning(f"No batch quote for {needs_fallback}, trying per-ticker chart metadata.")
+            with ThreadPoolExecutor(max_workers=min(FETCH_MAX_WORKERS, len(needs_fallback))) as ex: results = dict(zip(needs_fallback, ex.map(_fetch_one, needs_fallback)))
+            for ticker, (current_price, currency, short_name) in results.items():
+                stock_data[ticker] = {'current_price': current_price, 'currency': currency, 'short_name': short_name}
         logging.info(f"[Current Data] Finished fetching.")
-     except Exception as e_global: logging.error(f"Major error during yfinance Tickers fetch: {e_global}", exc_info=True); stock_data = {t:{'current_price': 0, 'currency': 'N/A', 'short_name': f"{t} (Global Fetch Error)"} for t in valid_tickers}
-     return stock_data
+    except Exception as e_global: logging.error(f"Major error during yfinance batch fetch: {e_global}", exc_info=True); stock_data = {t:{'current_price': 0, 'currency': 'N/A', 'short_name': f"{t} (Global Fetch Error)"} for t in valid_tickers}
+    return stock_data
+
+def _download_close(tickers, **kwargs):
+    # yf.download daily history reduced to a 'Close' frame with one column per ticker, or None.
+    import yfinance as yf
+    hist_data_raw = yf.download(tickers, interval="1d", progress=False, auto_adjust=True, actions=False, group_by='column', **kwargs)
+    if hist_data_raw is None or hist_data_raw.empty: return None
+    if 'Close' not in hist_data_raw.columns.get_level_values(0): logging.error("[History] Could not find 'Close' column group."); return None
+    hist_data = hist_data_raw['Close']  # Drop Open/High/Low/Volume before any further pandas work
+    if isinstance(hist_data, pd.Series): hist_data = hist_data.to_frame(name=tickers[0])  # Flat single-ticker frame
+    if hist_data.index.tz is not None: hist_data.index = hist_data.index.tz_localize(None)
+    return hist_data
+
+def _close_column(hist_data, ticker):
+    if hist_data is None or ticker not in hist_data.columns: return None
+    return hist_data[ticker].dropna()
+
+def _hist_cache_path(ticker): return os.path.join(HIST_CACHE_DIR, f"{ticker}.parquet")
+
+def _read_hist_cache(ticker):
+    path = _hist_cache_path(ticker)
+    if not os.path.exists(path): return None
+    try: return pd.read_parquet(path).set_index('Date')['Close']
+    except Exception as e: logging.warning(f"[History] Ignoring unreadable cache '{path}': {e}"); return None
+
+def _write_hist_cache(ticker, close):
+    path = _hist_cache_path(ticker); tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"  # Unique across gunicorn workers
+    try:
+        os.makedirs(HIST_CACHE_DIR, exist_ok=True)
+        close.rename('Close').rename_axis('Date').reset_index().to_parquet(tmp_path, index=False); os.replace(tmp_path, path)
+    except Exception as e: logging.warning(f"[History] Could not write cache '{path}': {e}")
+
+def _touch_hist_cache(ticker):
+    try: os.utime(_hist_cache_path(ticker))
+    except OSError as e: logging.warning(f"[History] Could not touch cache for {ticker}: {e}")
+
+def _load_close_history(tickers):
+    # Daily closes per ticker: cached series from HIST_CACHE_DIR topped up from one completed session before their last
+    # cached bar; tickers without a cache file get their full history in one batched download. The last cached bar is
+    # re-downloaded and overwritten because it may have been saved mid-session (an intraday price, not the close). The
+    # bar before it is the adjustment check: closes are split/dividend adjusted, so if Yahoo's value for it no longer
+    # matches the cache, the whole back-history was re-adjusted and the ticker is re-fetched in full. Files checked
+    # within HIST_RECHECK_SEC are used as-is, so weekends/holidays don't re-query Yahoo on every refresh.
+    today = pd.Timestamp.today().normalize(); now = time.time()
+    closes = {}; cold = []; stale = {}
+    for ticker in tickers:
+        cached = _read_hist_cache(ticker)
+        if cached is None or cached.empty: cold.append(ticker); continue
+        closes[ticker] = cached
+        if now - os.path.getmtime(_hist_cache_path(ticker)) >= HIST_RECHECK_SEC: stale.setdefault(cached.index[-2] if len(cached) > 1 else cached.index[-1], []).append(ticker)
+    for start, group in stale.items():
+        logging.info(f"[History] Fetching daily data since {start:%Y-%m-%d} for: {group}")
+        hist_data = _download_close(group, start=start, end=today + timedelta(days=1))
+        for ticker in group:
+            close = _close_column(hist_data, ticker); cached = closes[ticker]
+            if close is None or close.empty: _touch_hist_cache(ticker); continue  # Nothing new; still counts as checked
+            if len(cached) > 1 and start in close.index and not np.isclose(close[start], cached[start], rtol=HIST_ADJUST_RTOL):
+                logging.info(f"[History] {ticker} history was re-adjusted ({cached[start]:.4f} -> {close[start]:.4f} on {start:%Y-%m-%d}), re-fetching in full.")
+                cold.append(ticker); continue  # Cached series stays in closes if the full re-fetch fails
+            closes[ticker] = close.combine_first(cached); _write_hist_cache(ticker, closes[ticker])  # Fresh bars win
+    if cold:
+        logging.info(f"[History] Fetching max daily data for: {cold}")
+        hist_data = _download_close(cold, period="max")
+        for ticker in cold:
+            close = _close_column(hist_data, ticker)
+            if close is not None and not close.empty: closes[ticker] = close; _write_hist_cache(ticker, close)
+    logging.info(f"[History] Finished fetching.")
+    return pd.DataFrame(closes).sort_index() if closes else None
 
 def get_historical_data(tickers, portfolio_df):
-    # (Function remains the same as stock_tracker_py_csv_reverted_v5)
     if not tickers or portfolio_df.empty: return None
     try:
-        logging.info(f"[History] Fetching max daily data for: {tickers}")
-        hist_data_raw = yf.download(tickers, period="max", interval="1d", progress=False)
-        logging.info(f"[History] Finished fetching.")
-        if hist_data_raw.empty: logging.warning("[History] No historical data returned."); return None
-
-        hist_data = None
-        if isinstance(hist_data_raw.columns, pd.MultiIndex):
-            if 'Close' in hist_data_raw.columns.get_level_values(0): logging.info("[History] Selecting 'Close' from MultiIndex (level 0)."); hist_data = hist_data_raw['Close']
-            else:
-                 logging.warning("[History] 'Close' not found at level 0, trying swap."); hist_data_swapped = hist_data_raw.swaplevel(axis=1)
-                 if 'Close' in hist_data_swapped.columns.get_level_values(0): logging.info("[History] Selecting 'Close' after swap."); hist_data = hist_data_swapped['Close']
-                 else: logging.error("[History] Could not find 'Close' column group."); return None
-        else:
-            if 'Close' in hist_data_raw.columns: logging.info("[History] Selecting 'Close' from simple DF."); hist_data = hist_data_raw[['Close']]
-            else: logging.error("[History] Could not find 'Close' column in simple DF."); return None
-        if isinstance(hist_data, pd.Series): hist_data = hist_data.to_frame(name=hist_data.name)
-
-        hist_data = hist_data.ffill()
-        quantity_map = portfolio_df.set_index('Ticker')['Quantity'].to_dict()
+        hist_data = _load_close_history(tickers)
+        if hist_data is None or hist_data.empty: logging.warning("[History] No historical data returned."); return None
+
+        hist_data = hist_data.ffill().astype(np.float32, copy=False)  # Chart shows 2 decimals; halves the bytes the reduction reads
+        quantity_map = dict(zip(portfolio_df['Ticker'], portfolio_df['Quantity']))
         total_current_cost_basis = portfolio_df['CostBasis'].sum()
-        daily_total_values = {}; processed_tickers = []
-        for ticker in quantity_map.keys():
-            if ticker in hist_data.columns:
-                processed_tickers.append(ticker)
-                ticker_hist_value = (hist_data[ticker] * quantity_map[ticker])
-                for date, value in ticker_hist_value.items():
-                    if pd.notna(value): daily_total_values[date] = daily_total_values.get(date, 0) + value
-            else: logging.warning(f"[History] No historical 'Close' data processed for: {ticker}")
-        if not daily_total_values: logging.warning("[History] Could not calculate daily values."); return None
-        logging.info(f"[History] Calculated daily values using: {processed_tickers}")
-        sorted_dates = sorted(daily_total_values.keys()); dates_str = [d.strftime('%Y-%m-%d') for d in sorted_dates]
-        values = [daily_total_values[d] for d in sorted_dates]; gains = [v - total_current_cost_basis for v in values]
+        processed_tickers = hist_data.columns.intersection(list(quantity_map))
+        missing_tickers = pd.Index(list(quantity_map)).difference(processed_tickers)
+        if not missing_tickers.empty: logging.warning(f"[History] No historical 'Close' data processed for: {missing_tickers.tolist()}")
+        hist_data = hist_data[processed_tickers].dropna(how='all')  # Dates before any holding has a price carry no value
+        if hist_data.empty: logging.warning("[History] Could not calculate daily values."); return None
+        logging.info(f"[History] Calculated daily values using: {processed_tickers.tolist()}")
+        qty = pd.Series(quantity_map).reindex(hist_data.columns).fillna(0).values.astype(np.float32)
+        daily_total = (hist_data.fillna(0).values @ qty).astype(np.float64).round(2)  # Promote back; round off float32 noise before JSON
+        dates_str = hist_data.index.strftime('%Y-%m-%d').tolist()
+        values = daily_total; gains = daily_total - total_current_cost_basis  # Kept as ndarrays for app.json
         chart_data = { "dates": dates_str, "values": values, "gains": gains }; logging.info(f"[History] Prepared chart data: {len(dates_str)} points.")
         return chart_data
     except Exception as e: logging.error(f"Error fetching/processing historical data: {e}", exc_info=True); return None
 
+def _portfolio_key(csv_path):
+    try: stat = os.stat(csv_path); return (stat.st_mtime_ns, stat.st_size)
+    except OSError: return None
+
+def _refresh_snapshot(force=True, max_age=CACHE_TTL):
+    # Fetches quotes + history for the current portfolio and publishes them as the new _SNAPSHOT.
+    with _refresh_lock:
+        portfolio_key = _portfolio_key(PORTFOLIO_CSV)
+        if not force and _SNAPSHOT.get('portfolio_key') == portfolio_key: return dict(_SNAPSHOT)  # Another request just refreshed it
+        portfolio_df = load_portfolio_from_csv(PORTFOLIO_CSV)
+        if portfolio_df.empty: return {}
+        tickers = portfolio_df['Ticker'].unique().tolist()
+        with _snapshot_lock: previous = dict(_SNAPSHOT)
+        # Daily history only changes with the portfolio or at most once per HIST_RECHECK_SEC; quotes refresh every time
+        if previous.get('historical_data') and previous.get('portfolio_key') == portfolio_key and time.time() - previous['historical_at'] < HIST_RECHECK_SEC:
+            historical_data, historical_at = previous['historical_data'], previous['historical_at']
+        else: historical_data, historical_at = get_historical_data(tickers, portfolio_df), time.time()
+        snapshot = {'portfolio_key': portfolio_key, 'stock_data': get_stock_data(tickers, max_age), 'historical_data': historical_data, 'historical_at': historical_at}
+        with _snapshot_lock: _SNAPSHOT.clear(); _SNAPSHOT.update(snapshot)
+        return snapshot
+
+def _refresher():
+    while True:
+        time.sleep(REFRESH_SEC)
+        try: _refresh_snapshot()
+        except Exception as e: logging.error(f"[Snapshot] Background refresh failed: {e}", exc_info=True)
+
+def _get_snapshot():
+    # Started on first request rather than at import, so the debug reloader's parent process doesn't run one too.
+    global _refresher_thread
+    with _snapshot_lock:
+        if _refresher_thread is None: _refresher_thread = threading.Thread(target=_refresher, name='snapshot-refresher', daemon=True); _refresher_thread.start()
+        snapshot = dict(_SNAPSHOT)
+    if snapshot.get('portfolio_key') == _portfolio_key(PORTFOLIO_CSV): return snapshot
+    logging.info("[Snapshot] No snapshot for the current portfolio file, refreshing synchronously.")
+    # First page after a (re)start may use persisted prices up to QUOTE_DISK_TTL old; the refresher replaces them
+    return _refresh_snapshot(force=False, max_age=QUOTE_DISK_TTL if not snapshot else CACHE_TTL)
+
+# Per-holding fields passed to the template (as PortfolioRow namedtuple fields), in table order
+PORTFOLIO_DETAIL_KEYS = ['ticker', 'short_name', 'quantity', 'avg_purchase_price', 'cost_basis', 'current_price', 'current_value', 'gain_loss', 'gain_loss_percent', 'currency', 'is_rsu']
+
 # --- Flask Routes ---
+@app.before_request
+def _start_request_timer():
+    g.t0 = g.t_mark = time.perf_counter(); g.timings = {}
+
+@app.after_request
+def _log_request_timing(response):
+    phases = ''.join(f" {phase}={dt:.3f}s" for phase, dt in g.timings.items())
+    logging.info(f"[Timing] {request.method} {request.path} {response.status_code} total={time.perf_counter() - g.t0:.3f}s{phases}")
+    return response
+
+def _mark(phase):
+    # Seconds since the previous mark, logged per phase by _log_request_timing
+    now = time.perf_counter(); g.timings[phase] = now - g.t_mark; g.t_mark = now
+
 @app.route('/', methods=['GET'])
 def index():
-    portfolio_df = load_portfolio_from_csv(PORTFOLIO_CSV)
+    portfolio_df = load_portfolio_from_csv(PORTFOLIO_CSV); _mark('load')
     portfolio_details = []; error_message = None
     total_portfolio_value = 0.0; total_portfolio_cost_basis = 0.0; total_portfolio_gain_loss = 0.0
     rsu_total_value = 0.0; rsu_total_cost_basis = 0.0; rsu_total_gain_loss = 0.0
     non_rsu_total_value = 0.0; non_rsu_total_cost_basis = 0.0; non_rsu_total_gain_loss = 0.0
-    value_chart_data = None; gain_chart_data = None
+    value_chart_data = None; gain_chart_data = None; primary_currency = 'USD'
 
     if not os.path.exists(PORTFOLIO_CSV): error_message = f"Error: '{PORTFOLIO_CSV}' not found."
     elif portfolio_df.empty and os.path.exists(PORTFOLIO_CSV) and os.path.getsize(PORTFOLIO_CSV) == 0: error_message = f"'{PORTFOLIO_CSV}' is empty."
@@ -123,65 +372,62 @@ def index():
     if not portfolio_df.empty:
         tickers = portfolio_df['Ticker'].unique().tolist()
         logging.info(f"Tickers loaded from CSV: {tickers}")
-        stock_data = get_stock_data(tickers)
-
-        for index, row in portfolio_df.iterrows():
-            ticker = row['Ticker']; quantity = row['Quantity']; cost_basis = row['CostBasis']
-            data = stock_data.get(ticker)
-            current_price = 0; current_value = 0; avg_purchase_price = 0
-            gain_loss = 0; gain_loss_percent = 0; currency = 'N/A'; short_name = ticker
-            is_rsu = ticker in RSU_TICKERS
-            try:
-                quantity = float(quantity); cost_basis = float(cost_basis)
-                if quantity != 0: avg_purchase_price = cost_basis / quantity
-                else: avg_purchase_price = 0
-                total_portfolio_cost_basis += cost_basis
-                if data and data.get('current_price') is not None and data['current_price'] > 0:
-                    current_price = float(data['current_price']); current_value = quantity * current_price
-                    gain_loss = current_value - cost_basis
-                    if cost_basis != 0: gain_loss_percent = (gain_loss / cost_basis) * 100
-                    currency = data.get('currency', 'N/A'); short_name = data.get('short_name', ticker)
-                else:
-                    short_name = data.get('short_name', f"{ticker} (Load Error)") if data else f"{ticker} (Not Found)"
-                    currency = data.get('currency', 'N/A') if data else 'N/A'; current_value = 0; gain_loss = 0 - cost_basis
-                    if cost_basis != 0: gain_loss_percent = -100.0
-                total_portfolio_value += current_value; total_portfolio_gain_loss += gain_loss
-                if is_rsu: rsu_total_cost_basis += cost_basis; rsu_total_value += current_value; rsu_total_gain_loss += gain_loss
-                else: non_rsu_total_cost_basis += cost_basis; non_rsu_total_value += current_value; non_rsu_total_gain_loss += gain_loss
-                portfolio_details.append({'ticker': ticker, 'short_name': short_name, 'quantity': quantity, 'avg_purchase_price': avg_purchase_price, 'cost_basis': cost_basis, 'current_price': current_price, 'current_value': current_value, 'gain_loss': gain_loss, 'gain_loss_percent': gain_loss_percent, 'currency': currency, 'is_rsu': is_rsu})
-            except Exception as e: logging.error(f"Calculation error for {ticker}: {e}", exc_info=True); portfolio_details.append({'ticker': ticker, 'short_name': f"{ticker} (Calc Error)", 'quantity': quantity, 'avg_purchase_price': 0, 'cost_basis': cost_basis, 'current_price': 0, 'current_value': 0, 'gain_loss': 0, 'gain_loss_percent': 0, 'currency': 'N/A', 'is_rsu': is_rsu})
-
-        portfolio_details.sort(key=lambda x: x['ticker'])
-        historical_data = get_historical_data(tickers, portfolio_df)
+        snapshot = _get_snapshot(); _mark('snapshot')
+        stock_data = snapshot.get('stock_data') or {}
+
+        df = portfolio_df[['Ticker', 'Quantity', 'CostBasis']].rename(columns={'Ticker': 'ticker', 'Quantity': 'quantity', 'CostBasis': 'cost_basis'})
+        quotes = pd.DataFrame.from_dict(stock_data, orient='index', columns=['current_price', 'currency', 'short_name'])
+        df = df.join(quotes, on='ticker')
+        prices = pd.to_numeric(df['current_price'], errors='coerce').fillna(0).astype(float)
+        prices = prices.where(prices > 0, 0.0)  # Missing/failed quotes count as a total loss, as before
+        df['current_price'] = prices
+        df['currency'] = df['currency'].fillna('N/A')
+        df['short_name'] = df['short_name'].fillna(df['ticker'] + ' (Not Found)')
+        df['current_value'] = df['quantity'] * prices
+        df['gain_loss'] = df['current_value'] - df['cost_basis']
+        df['avg_purchase_price'] = (df['cost_basis'] / df['quantity'].replace(0, np.nan)).fillna(0)
+        df['gain_loss_percent'] = np.where(df['cost_basis'] != 0, df['gain_loss'] / df['cost_basis'].replace(0, np.nan) * 100, 0)
+        df['is_rsu'] = df['ticker'].isin(RSU_TICKERS)
+
+        total_portfolio_value = float(df['current_value'].sum()); total_portfolio_cost_basis = float(df['cost_basis'].sum()); total_portfolio_gain_loss = float(df['gain_loss'].sum())
+        totals = df.groupby('is_rsu')[['cost_basis', 'current_value', 'gain_loss']].sum().reindex([True, False], fill_value=0.0)
+        rsu_total_cost_basis, rsu_total_value, rsu_total_gain_loss = map(float, totals.loc[True])
+        non_rsu_total_cost_basis, non_rsu_total_value, non_rsu_total_gain_loss = map(float, totals.loc[False])
+        df = df.sort_values('ticker', kind='stable')
+        portfolio_details = list(df[PORTFOLIO_DETAIL_KEYS].itertuples(index=False, name='PortfolioRow'))  # Namedtuples; Jinja reads stock.ticker etc. as attributes
+        # Primary currency: most common among priced holdings (ties -> first by ticker), else first known currency
+        known = df['currency'] != 'N/A'
+        counts = df.loc[known & (df['current_value'] > 0), 'currency'].value_counts(sort=False)
+        if not counts.empty: primary_currency = counts.idxmax()
+        elif known.any(): primary_currency = df.loc[known, 'currency'].iloc[0]
+
+        historical_data = snapshot.get('historical_data')
         if historical_data:
             value_chart_data = {"labels": historical_data["dates"], "datasets": [{"label": "Portfolio Value", "data": historical_data["values"], "borderColor": 'rgb(79, 70, 229)', "tension": 0.1, "pointRadius": 0, "borderWidth": 2}]}
             # --- REMOVED backgroundColor lambda ---
             gain_chart_data = {"labels": historical_data["dates"], "datasets": [{"label": "Portfolio Gain/Loss", "data": historical_data["gains"], "borderColor": 'rgb(16, 185, 129)', "tension": 0.1, "pointRadius": 0, "borderWidth": 2, "fill": { "target": "origin", "above": "rgba(16, 185, 129, 0.1)" } }]}
 
-    primary_currency = 'USD'
-    if portfolio_details:
-        valid_currencies = [p['currency'] for p in portfolio_details if p['currency'] != 'N/A' and p.get('current_value', 0) > 0]
-        if valid_currencies:
-            try: primary_currency = max(set(valid_currencies), key=valid_currencies.count)
-            except ValueError: primary_currency = 'USD'
-        elif any(p['currency'] != 'N/A' for p in portfolio_details):
-             primary_currency = next((p['currency'] for p in portfolio_details if p['currency'] != 'N/A'), 'USD')
-
-    current_time_formatted = datetime.now().strftime('%Y-%m-%d %H:%M:%S %Z')
+    current_time_formatted = datetime.now().strftime('%Y-%m-%d %H:%M:%S %Z'); _mark('compute')
 
-    return render_template('index.html',
+    html = render_template('index.html',
                            portfolio=portfolio_details,
                            total_value=total_portfolio_value, total_cost_basis=total_portfolio_cost_basis, total_gain_loss=total_portfolio_gain_loss,
                            rsu_total_value=rsu_total_value, rsu_total_cost_basis=rsu_total_cost_basis, rsu_total_gain_loss=rsu_total_gain_loss,
                            non_rsu_total_value=non_rsu_total_value, non_rsu_total_cost_basis=non_rsu_total_cost_basis, non_rsu_total_gain_loss=non_rsu_total_gain_loss,
-                           value_chart_data_json=json.dumps(value_chart_data) if value_chart_data else None,
-                           gain_chart_data_json=json.dumps(gain_chart_data) if gain_chart_data else None, # Pass gain data
+                           value_chart_data_json=app.json.dumps(value_chart_data) if value_chart_data else None,
+                           gain_chart_data_json=app.json.dumps(gain_chart_data) if gain_chart_data else None, # Pass gain data
                            primary_currency=primary_currency, error_message=error_message,
                            portfolio_csv_name=PORTFOLIO_CSV, current_time=current_time_formatted)
+    _mark('render')
+    return html
 
 # --- Main Execution ---
 if __name__ == '__main__':
-    logging.info("Starting Flask development server...")
     if not os.path.exists(PORTFOLIO_CSV):
          print(f"\nERROR: '{PORTFOLIO_CSV}' not found.\n", file=sys.stderr)
-    app.run(debug=True, host='0.0.0.0', port=5001)
+    if os.environ.get('FLASK_ENV') == 'development':
+        logging.info("Starting Flask development server (debug, auto-reload)...")
+        app.run(debug=True, host='0.0.0.0', port=5001)
+    else:
+        logging.info("Starting Flask server (threaded). For production use: gunicorn -w 2 -k gthread --threads 8 wsgi:app -b 0.0.0.0:5001")
+        app.run(debug=False, threaded=True, host='0.0.0.0', port=5001)
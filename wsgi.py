@@ -0,0 +1,5 @@
+# wsgi.py
+# WSGI entry point for production servers, e.g.:
+#   gunicorn -w 2 -k gthread --threads 8 wsgi:app -b 0.0.0.0:5001
+# For local runs use `python app.py`.
+from app import app